@@ -1,10 +1,19 @@
 import os
+import asyncio
 import re
 import json
 import hashlib
+import functools
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+import logging.handlers
+import queue
 import sys
+from contextlib import asynccontextmanager
 from typing import Optional, Dict, Any, Literal
 from urllib.parse import urljoin, urlparse, parse_qs
 
@@ -23,7 +32,42 @@ SKY_ID  = os.getenv("SKYWORK_SECRET_ID", "")
 SKY_KEY = os.getenv("SKYWORK_SECRET_KEY", "")
 MCP_SSE = os.getenv("SKYWORK_MCP_SSE_URL", "https://api.skywork.ai/open/sse")
 
-app = FastAPI(title=APP_NAME)
+# 全局复用连接池：SSE 长连接与 tools/call 回调共用 keep-alive，省去每次的 TCP+TLS 握手
+# 注意：Retry 默认不重试 POST（非幂等），raise_on_status=False 保留下面对非 200 的处理逻辑
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+SESSION.headers["User-Agent"] = "DeckPilot/1.0"
+
+# 后台 tools/call 任务需持有强引用，否则可能在完成前被 GC 回收
+_TOOLS_CALL_TASKS = set()
+
+# SSE 主链路走异步客户端：一个事件循环线程即可同时挂住多个长连接，不再占用线程池
+def _new_async_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        timeout=httpx.Timeout(1200.0, connect=10.0),
+        headers={"User-Agent": "DeckPilot/1.0"},
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 客户端与 lifespan 同生命周期：每次启动新建，关闭时释放，app 可重复启停
+    LOG_LISTENER.start()
+    app.state.async_client = _new_async_client()
+    try:
+        yield
+    finally:
+        await app.state.async_client.aclose()
+        LOG_LISTENER.stop()
+
+app = FastAPI(title=APP_NAME, lifespan=lifespan)
 
 # CORS（按需放宽）
 allowed_origins = [
@@ -59,75 +103,136 @@ class ToolsCallReq(BaseModel):
     arguments: Dict[str, Any] = Field(default_factory=dict)
     context: Dict[str, Any] = Field(default_factory=dict)
 
+# mode -> Skywork 工具名 -> 导出格式（mode 已由 MakeDeckReq 的 Literal 校验）
+MODE_TO_TOOL = {"ppt": "gen_ppt", "ppt-fast": "gen_ppt_fast", "doc": "gen_doc", "excel": "gen_excel"}
+TOOL_TO_EXT = {"gen_ppt": "pptx", "gen_ppt_fast": "pptx", "gen_doc": "docx", "gen_excel": "xlsx"}
+
 # =========================
 # Logging Config (全量日志记录)
 # =========================
 # 同时输出到 控制台 和 server.log 文件
+# 记录日志只是往队列里 put 一条，真正的写盘/打印由后台线程完成，不阻塞事件循环
+_log_formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
+_log_handlers = [
+    logging.FileHandler("server.log", encoding='utf-8'), # 记录到文件
+    logging.StreamHandler(sys.stdout)                    # 输出到黑窗口
+]
+for _h in _log_handlers:
+    _h.setFormatter(_log_formatter)
+_log_queue = queue.Queue(-1)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.FileHandler("server.log", encoding='utf-8'), # 记录到文件
-        logging.StreamHandler(sys.stdout)                    # 输出到黑窗口
-    ]
+    format='%(message)s',  # 入队时只保留消息本身，时间/级别由后台 handler 的格式补上
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
+# 在 lifespan 里启停
+LOG_LISTENER = logging.handlers.QueueListener(_log_queue, *_log_handlers, respect_handler_level=True)
 logger = logging.getLogger("DeckPilot")
+# httpx 在 INFO 级别会打印完整请求 URL，SSE 的 query 里带着 secret_id/sign 和用户输入，不能落盘
+logging.getLogger("httpx").setLevel(logging.WARNING)
 # =========================
 # Utils (优化版)
 # =========================
+def _on_tools_call_done(task: asyncio.Task) -> None:
+    """后台 tools/call 结束时的回调：只负责记日志，错误帧由读取循环推送"""
+    _TOOLS_CALL_TASKS.discard(task)
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        logger.error(f"!!! [Tools Call Failed] {str(exc)}")
+
+@functools.lru_cache(maxsize=4)
 def sky_sign(secret_id: str, secret_key: str) -> str:
     return hashlib.md5(f"{secret_id}:{secret_key}".encode("utf-8")).hexdigest()
 
+# 密钥来自启动时的环境变量，签名在进程生命周期内不变，算一次即可
+SKY_SIGN = sky_sign(SKY_ID, SKY_KEY) if SKY_ID and SKY_KEY else ""
+
 def build_query(req: MakeDeckReq) -> str:
-    # ... (保持不变) ...
-    if req.outline_md:
-        prefix = f"请基于以下大纲生成：\n{req.outline_md}\n"
-    else:
-        mode_desc = {
-            "ppt": "{topic}",
-            "ppt-fast": "{topic}",
-            "doc": "{topic}",
-            "excel": "{topic}"
-        }
-        prefix = mode_desc.get(req.mode, mode_desc["ppt-fast"]).format(topic=req.topic)
+    # 各 mode 的说明都只是 {topic} 本身，直接用 topic
+    prefix = f"请基于以下大纲生成：\n{req.outline_md}\n" if req.outline_md else req.topic
     hint = f" 模板/品牌要求：{req.template_hint}。" if req.template_hint else ""
     return (prefix + hint).strip()
 
 # —— 优化正则，增加容错 ——
 URL_RE = re.compile(r'https?://[^\s"\'<>]+', re.IGNORECASE)
+_URL_ESCAPES = re.compile(r'(?:\\u[0-9A-Fa-f]{4})+')
 PREFERRED_EXTS = tuple(os.getenv("DECKPILOT_PREFERRED_EXTS", "pptx,docx,xlsx,pdf,zip").lower().split(","))
+# 后缀 -> 加分，启动时算好；按 PREFERRED_EXTS 顺序排列，越靠前分越高
+PREFERRED_EXT_SCORES = {"." + ext: 100 - i for i, ext in enumerate(PREFERRED_EXTS, start=1)}
+# 单个 SSE 帧的上限（默认 4 MiB），防止上游异常时缓冲区无限增长
+MAX_FRAME_BYTES = int(os.getenv("DECKPILOT_MAX_FRAME_BYTES", str(4 * 1024 * 1024)))
+
+# —— 固定的 SSE 帧：直接以 bytes 输出，StreamingResponse 无需再编码 ——
+DONE_FRAME = b"event: done\ndata: [DONE]\n\n"
+EOF_FRAME = b": EOF\n\n"
+PING_FRAME = b"event: log\ndata: ...\n\n"
+CONNECTED_FRAME = "event: log\ndata: 已连接引擎，正在生成大纲与内容...\n\n".encode("utf-8")
+FRAME_TOO_LARGE_FRAME = b"event: error\ndata: frame too large\n\n"
+
+# —— 每帧/每次 tools/call 都会用到的常量，启动时建好 ——
+_TOKEN_EXH_RE = re.compile(rb"token exhausted", re.IGNORECASE)
+_ARGS_TEMPLATE = {
+    "query": "",
+    "use_network": "false",
+    "export": None,
+    "status_updates": True,
+    "debug": True,
+}
 
 def _safe_decode(b_line: bytes) -> str:
-    """强制使用 UTF-8 解码，忽略错误，防止流中断"""
-    try:
-        return b_line.decode("utf-8")
-    except UnicodeDecodeError:
-        try:
-            return b_line.decode("utf-8", errors="ignore")
-        except Exception:
-            return b_line.decode("latin1", errors="ignore")
+    """强制使用 UTF-8 解码，忽略错误，防止流中断（errors="ignore" 不会抛异常）"""
+    return b_line.decode("utf-8", "ignore")
 
 def _collect_urls_from_text(text: str) -> list[str]:
     """简单粗暴地从文本中提取所有 URL"""
-    return list(set(URL_RE.findall(text)))
+    # 绝大多数帧不含 URL：先用 C 层子串查找过滤，命中了再跑正则
+    if "://" not in text:
+        return []
+    return URL_RE.findall(text)
 
+@functools.lru_cache(maxsize=2048)
 def _score_url(u: str) -> int:
-    # ... (保持不变) ...
+    # 同一个 URL 会在多条进度帧里反复出现，结果缓存起来
     s = u.lower()
     score = 10
-    for i, ext in enumerate(PREFERRED_EXTS, start=1):
-        if s.endswith("." + ext):
-            score += 100 - i
+    for ext, bonus in PREFERRED_EXT_SCORES.items():
+        if s.endswith(ext):
+            score += bonus
+            break
     if "download" in s or "export" in s or "file" in s:
         score += 15
     if "signature=" in s or "token=" in s:
         score += 10
     return score
 
+def _decode_u_escapes(m: re.Match) -> str:
+    # 一整段连续的 \\uXXXX 一起解码，代理对（如 \\ud83d\\ude00）才能拼回一个字符；
+    # 落单的代理项原样保留，否则日志和 orjson.dumps 都会因非法 UTF-8 报错
+    hexes = m.group(0)[2:].split("\\u")
+    out = []
+    i = 0
+    while i < len(hexes):
+        cu = int(hexes[i], 16)
+        lo = int(hexes[i + 1], 16) if i + 1 < len(hexes) else 0
+        if 0xD800 <= cu < 0xDC00 and 0xDC00 <= lo < 0xE000:
+            out.append(chr(0x10000 + ((cu - 0xD800) << 10) + (lo - 0xDC00)))
+            i += 2
+            continue
+        out.append("\\u" + hexes[i] if 0xD800 <= cu < 0xE000 else chr(cu))
+        i += 1
+    return "".join(out)
+
+def _unescape_url(u: str) -> str:
+    """还原 URL 里残留的 JSON \\uXXXX 转义（常见的是 \\u0026 -> &）"""
+    if "\\u" not in u:
+        return u
+    return _URL_ESCAPES.sub(_decode_u_escapes, u)
+
 def _pick_best_url(urls: list[str]) -> Optional[str]:
-    if not urls:
-        return None
-    return sorted(urls, key=_score_url, reverse=True)[0]
+    # 只要最高分的一个，max 一遍即可，不必排序；重复 URL 对结果没有影响
+    return max(urls, key=_score_url, default=None)
 
 def _endpoint_and_context_from_data(data: str):
     # ... (保持不变) ...
@@ -194,7 +299,7 @@ def tools_call_proxy(req: ToolsCallReq):
         "jsonrpc": "2.0",
         "id": 1,
         "secret_id": SKY_ID,
-        "sign": sky_sign(SKY_ID, SKY_KEY),
+        "sign": SKY_SIGN,
         "method": "tools/call",
         "params": {
             "name": req.name,
@@ -204,7 +309,7 @@ def tools_call_proxy(req: ToolsCallReq):
     if req.context:
         payload["params"]["context"] = req.context
     try:
-        r = requests.post(req.endpoint, json=payload, headers={"Accept": "application/json"}, timeout=60)
+        r = SESSION.post(req.endpoint, json=payload, headers={"Accept": "application/json"}, timeout=60)
         return {"status_code": r.status_code, "headers": dict(r.headers), "text": r.text}
     except requests.RequestException as e:
         raise HTTPException(502, f"POST failed: {e}")
@@ -213,62 +318,70 @@ def tools_call_proxy(req: ToolsCallReq):
 # 核心修复部分
 # =========================
 @app.post("/make-deck-stream")
-def make_deck_stream(req: MakeDeckReq):
+async def make_deck_stream(req: MakeDeckReq, request: Request):
     # [LOG] 记录请求的完整参数，确认 OpenWebUI 是否传入了页数限制
     logger.info(f">>> [收到请求] Topic: {req.topic} | UseNetwork: {req.use_network} | Mode: {req.mode}")
 
     if not SKY_ID or not SKY_KEY:
         raise HTTPException(500, "Server is not configured with SKYWORK_SECRET_ID/KEY")
 
-    mode_to_tool = {"ppt":"gen_ppt", "ppt-fast":"gen_ppt_fast", "doc":"gen_doc", "excel":"gen_excel"}
-    tool_name = mode_to_tool.get(req.mode, "gen_ppt_fast")
-    export_ext = {"gen_ppt":"pptx", "gen_ppt_fast":"pptx", "gen_doc":"docx", "gen_excel":"xlsx"}[tool_name]
+    tool_name = MODE_TO_TOOL[req.mode]
+    export_ext = TOOL_TO_EXT[tool_name]
 
     query_text = build_query(req)
     sse_params = {
         "secret_id": SKY_ID,
-        "sign": sky_sign(SKY_ID, SKY_KEY),
+        "sign": SKY_SIGN,
         "query": query_text,
         "use_network": str(req.use_network).lower(),
         "status_updates": "true",
         "debug": "true",
     }
 
-    def event_stream():
-        headers = {"Accept": "text/event-stream", "Connection": "keep-alive"}
+    client = request.app.state.async_client
+
+    async def event_stream():
+        # identity：SSE 不压缩，读取时才能跳过解码层直接拿原始字节
+        headers = {"Accept": "text/event-stream", "Accept-Encoding": "identity", "Connection": "keep-alive"}
         sent_done = False
 
         logger.info(f"--- 开始连接 Skywork SSE: {MCP_SSE} ---")
 
         try:
-            # 使用 decode_unicode=False 获取原始字节，防止中文乱码中断连接
-            with requests.get(MCP_SSE, params=sse_params, headers=headers, stream=True, timeout=1200) as r:
+            # 自己按字节切行，拿到原始字节再解码，防止中文乱码中断连接
+            async with client.stream("GET", MCP_SSE, params=sse_params, headers=headers) as r:
                 if r.status_code != 200:
+                    await r.aread()
                     err_msg = f"SSE connect failed: {r.text}"
                     logger.error(f"!!! [Skywork Error] {err_msg}")
-                    yield f"event: error\ndata: {err_msg}\n\n"
-                    yield "event: done\ndata: [DONE]\n\n"
+                    yield f"event: error\ndata: {err_msg}\n\n".encode("utf-8")
+                    yield DONE_FRAME
                     return
 
                 endpoint_url = None
                 called = False
+                call_task = None
                 context = {}
-                buffer = []
-
-                def flush_and_emit(buf):
-                    nonlocal endpoint_url, called, context, sent_done
-                    if not buf or sent_done:
+                event_name = b"message"
+                data_parts = []
+
+                # 内部没有 await（tools/call 已交给后台任务），用普通生成器即可，
+                # 省掉异步生成器每步都要走一遍 awaitable 协议的开销
+                def flush_and_emit(name, parts):
+                    nonlocal endpoint_url, called, call_task, context, sent_done
+                    if not parts or sent_done:
                         return
 
                     # 1. 这里是关键！必须先定义 data_str，才能在下面打日志
-                    name, data_str = "message", ""
-                    for ln in buf:
-                        if ln.startswith("event:"):
-                            name = ln.split(":", 1)[1].strip()
-                        elif ln.startswith("data:"):
-                            data_str += ln.split(":", 1)[1].lstrip() + "\n"
-                    
-                    data_str = data_str.strip()
+                    # 整帧 data 只在这里解码一次；JSON 解析直接吃原始字节
+                    data_bytes = b"\n".join(parts).strip()
+                    # 心跳是空闲时最常见的帧：原始字节里认出紧凑写法的 ping 就直接回，
+                    # 解码、URL 扫描、JSON 解析统统跳过
+                    if b'"method":"ping"' in data_bytes:
+                        yield PING_FRAME
+                        return
+
+                    data_str = _safe_decode(data_bytes)
                     if not data_str:
                         return
 
@@ -281,78 +394,75 @@ def make_deck_stream(req: MakeDeckReq):
                     best_link = _pick_best_url(raw_urls)
                     
                     if best_link:
-                        best_link = best_link.replace(r"\u0026", "&")
+                        best_link = _unescape_url(best_link)
                         logger.info(f">>> [任务完成] 捕获到下载链接: {best_link}")
-                        yield "event: done\ndata: " + json.dumps(
-                            {"download_url": best_link}, ensure_ascii=False
-                        ) + "\n\n"
-                        yield ": EOF\n\n"
+                        yield b"event: done\ndata: " + orjson.dumps({"download_url": best_link}) + b"\n\n"
+                        yield EOF_FRAME
                         sent_done = True
                         return
 
                     # 4. JSON 解析与逻辑处理
+                    # 只有 { 开头才可能是我们关心的 JSON，纯文本帧不再靠抛异常来排除
                     json_obj = None
-                    try:
-                        json_obj = json.loads(data_str)
-                    except Exception:
-                        pass
+                    if data_bytes[:1] == b"{":
+                        try:
+                            json_obj = orjson.loads(data_bytes)
+                        except orjson.JSONDecodeError:
+                            # orjson 拒绝非法 UTF-8：退回到已忽略坏字节解码后的 data_str 再试一次
+                            try:
+                                json_obj = orjson.loads(data_str)
+                            except orjson.JSONDecodeError:
+                                json_obj = None
 
                     if isinstance(json_obj, dict) and json_obj.get("method") == "ping":
                         # 发送一个看不见的字符或者点，保持连接活跃
-                        yield "event: log\ndata: ...\n\n"
+                        yield PING_FRAME
                         return
 
                     # Endpoint 处理
-                    if name == "endpoint":
+                    if name == b"endpoint":
                         endpoint_url, ctx = _endpoint_and_context_from_data(data_str)
                         if ctx:
                             context.update(ctx)
 
                         if not called and endpoint_url:
                             logger.info(f"--> [Trigger] 正在向 {endpoint_url} 发起 tools/call")
-                            arguments = {
-                                "query": sse_params.get("query", ""),
-                                "use_network": sse_params.get("use_network", "false"),
+                            arguments = _ARGS_TEMPLATE | {
+                                "query": sse_params["query"],
+                                "use_network": sse_params["use_network"],
                                 "export": export_ext,
-                                "status_updates": True,
-                                "debug": True,
                             }
                             payload = {
                                 "jsonrpc": "2.0",
                                 "id": 1,
                                 "secret_id": SKY_ID,
-                                "sign": sky_sign(SKY_ID, SKY_KEY),
+                                "sign": SKY_SIGN,
                                 "method": "tools/call",
                                 "params": {"name": tool_name, "arguments": arguments},
                             }
                             if context:
                                 payload["params"]["context"] = context
                             
-                            try:
-                                _ = requests.post(
-                                    endpoint_url,
-                                    json=payload,
-                                    headers={"Accept": "application/json"},
-                                    timeout=60,
-                                )
-                            except Exception as e:
-                                logger.error(f"!!! [Tools Call Failed] {str(e)}")
-                                yield f"event: error\ndata: tools/call failed: {str(e)}\n\n"
-                                if not sent_done:
-                                    yield "event: done\ndata: [DONE]\n\n"
-                                    sent_done = True
-                                return
-                            
+                            # 放到后台执行，读取循环不必等服务端处理完才继续消费 SSE
+                            call_task = asyncio.create_task(client.post(
+                                endpoint_url,
+                                json=payload,
+                                headers={"Accept": "application/json"},
+                                timeout=60,
+                            ))
+                            _TOOLS_CALL_TASKS.add(call_task)
+                            call_task.add_done_callback(_on_tools_call_done)
                             called = True
                             # 明确告诉前端正在生成
-                            yield "event: log\ndata: 已连接引擎，正在生成大纲与内容...\n\n"
+                            yield CONNECTED_FRAME
                         return
 
-                    if "token exhausted" in data_str.lower():
+                    # 直接在原始字节上做大小写无关匹配，不再为整帧 lower() 一份拷贝
+                    if _TOKEN_EXH_RE.search(data_bytes):
                         logger.warning("!!! Token Exhausted")
-                        yield "event: error\ndata: Token exhausted\n\n"
+                        yield b"event: error\ndata: Token exhausted\n\n"
                         if not sent_done:
-                            yield "event: done\ndata: [DONE]\n\n"
+                            yield DONE_FRAME
                             sent_done = True
                         return
 
@@ -373,31 +483,122 @@ def make_deck_stream(req: MakeDeckReq):
 
                     if log_msg:
                          # logger.info(f">>> [推送前端] {log_msg}")
-                         yield f"event: log\ndata: {log_msg}\n\n"
+                         yield f"event: log\ndata: {log_msg}\n\n".encode("utf-8")
 
                 # —— 读取循环 —— 
-                for raw_line in r.iter_lines(decode_unicode=False):
+                # 按字节切帧：只看行首字节分派 event:/data:，注释行（:）和 id:/retry: 直接跳过，不逐行解码
+                accum = bytearray()
+                frame_bytes = 0         # 当前帧已累计的字节数
+                dropping_frame = False  # 当前帧已超限，丢弃到帧结束的空行为止
+                in_oversized_line = False  # 超长半行已被清掉，下一个 \n 只是它的行尾，不是空行
+                # 不指定 chunk_size：httpx 会攒满 chunk_size 才吐出数据，SSE 帧会被憋住；
+                # 底层 httpcore 每次最多从 socket 读 64 KiB，突发大帧时块本身就足够大。
+                # 未压缩时直接用 aiter_raw()，绕过 aiter_bytes 的解码 + 分块两层迭代器
+                if r.headers.get("content-encoding", "identity").lower() == "identity":
+                    chunks = r.aiter_raw()
+                else:
+                    chunks = r.aiter_bytes()
+                chunk_iter = chunks.__aiter__()
+                while True:
+                    if call_task is None:
+                        try:
+                            chunk = await chunk_iter.__anext__()
+                        except StopAsyncIteration:
+                            break
+                    else:
+                        # 后台 tools/call 还没结束：读下一块与它赛跑，失败要立刻推给前端，
+                        # 不能等上游的下一条数据（上游不再发 ping 时要等到读超时）
+                        read_task = asyncio.ensure_future(chunk_iter.__anext__())
+                        try:
+                            await asyncio.wait({read_task, call_task}, return_when=asyncio.FIRST_COMPLETED)
+                        except BaseException:
+                            read_task.cancel()
+                            raise
+                        if call_task.done():
+                            exc = None if call_task.cancelled() else call_task.exception()
+                            call_task = None
+                            if exc is not None:
+                                # 与原先同步调用时一样推送错误并结束
+                                read_task.cancel()
+                                yield f"event: error\ndata: tools/call failed: {str(exc)}\n\n".encode("utf-8")
+                                yield DONE_FRAME
+                                sent_done = True
+                                break
+                        try:
+                            chunk = await read_task
+                        except StopAsyncIteration:
+                            break
+
+                    if in_oversized_line:
+                        # 先丢掉超长行剩下的部分（含结尾的 \n），之后才恢复正常切行
+                        nl = chunk.find(b"\n")
+                        if nl < 0:
+                            continue
+                        chunk = chunk[nl + 1:]
+                        in_oversized_line = False
+
+                    scan_from = len(accum)  # 上一轮剩下的半行里肯定没有换行，不必重扫
+                    accum += chunk
+                    start = 0
+                    out_parts = []  # 同一块里解析出的所有输出帧合并成一次 yield
+                    while not sent_done:
+                        end = accum.find(b"\n", scan_from)
+                        if end < 0:
+                            break
+                        line_start, line_end = start, end
+                        start = scan_from = end + 1
+                        if line_end > line_start and accum[line_end - 1] == 0x0D:  # \r
+                            line_end -= 1
+
+                        if line_end == line_start:
+                            if dropping_frame:
+                                dropping_frame = False
+                            else:
+                                out_parts.extend(flush_and_emit(event_name, data_parts))
+                            event_name, data_parts, frame_bytes = b"message", [], 0
+                            continue
+                        if dropping_frame:
+                            continue
+
+                        frame_bytes += line_end - line_start
+                        if frame_bytes > MAX_FRAME_BYTES:
+                            logger.warning(f"!!! [Frame Too Large] 单帧超过 {MAX_FRAME_BYTES} 字节，已丢弃")
+                            out_parts.append(FRAME_TOO_LARGE_FRAME)
+                            data_parts, dropping_frame = [], True
+                        elif accum[line_start] == 0x64 and accum.startswith(b"data:", line_start, line_end):  # d
+                            value_start = line_start + 5
+                            if value_start < line_end and accum[value_start] == 0x20:
+                                value_start += 1
+                            data_parts.append(accum[value_start:line_end])
+                        elif accum[line_start] == 0x65 and accum.startswith(b"event:", line_start, line_end):  # e
+                            event_name = accum[line_start + 6:line_end].strip()
+                    del accum[:start]
+                    # 没有换行的超长半行同样计入上限，超了就整段丢掉，不再往下攒。
+                    # 只有真的有半行被清掉时才标记 in_oversized_line；已在丢弃的帧只看半行自身长度，
+                    # 否则 frame_bytes 超限后每次读到行尾都会误吞下一块开头的空行
+                    pending_bytes = len(accum) if dropping_frame else frame_bytes + len(accum)
+                    if accum and pending_bytes > MAX_FRAME_BYTES:
+                        if not dropping_frame:
+                            logger.warning(f"!!! [Frame Too Large] 单帧超过 {MAX_FRAME_BYTES} 字节，已丢弃")
+                            out_parts.append(FRAME_TOO_LARGE_FRAME)
+                            data_parts, dropping_frame = [], True
+                        accum.clear()
+                        in_oversized_line = True
+                    if out_parts:
+                        yield b"".join(out_parts)
+
                     if sent_done:
                         break
-                    
-                    if raw_line:
-                        # 必须使用 _safe_decode，在 app.py 其他地方定义的那个函数
-                        line = _safe_decode(raw_line).strip()
-                        buffer.append(line)
-                    else:
-                        for out in (flush_and_emit(buffer) or []):
-                            yield out
-                        buffer = []
 
                 if not sent_done:
                     logger.info("--- Stream ended without explicit DONE, sending DONE manually ---")
-                    yield "event: done\ndata: [DONE]\n\n"
+                    yield DONE_FRAME
                     sent_done = True
 
         except Exception as e:
             logger.error(f"!!! [Stream Exception] {str(e)}")
-            yield f"event: error\ndata: {str(e)}\n\n"
+            yield f"event: error\ndata: {str(e)}\n\n".encode("utf-8")
             if not sent_done:
-                yield "event: done\ndata: [DONE]\n\n"
+                yield DONE_FRAME
 
     return StreamingResponse(event_stream(), media_type="text/event-stream")
\ No newline at end of file